@@ -3,14 +3,23 @@
 import os
 import re
 import sys
-import pickle
+import json
+import builtins
+import time
+import heapq
 import shutil
 import logging
+import functools
+import threading
 import platform
 from zipfile import ZipFile
-from stat import S_IRUSR, S_IXUSR
+from stat import S_IRUSR, S_IXUSR, S_ISDIR, S_ISLNK
+from operator import attrgetter
 from contextlib import contextmanager
-from subprocess import run, PIPE, STDOUT, Popen
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from subprocess import run, PIPE, STDOUT, DEVNULL, Popen
+
+# The list command below shadows the builtin, so it is used as builtins.list.
 
 ### Logging ###
 from rich import print
@@ -28,20 +37,61 @@ logger = logging.getLogger("rich")
 ### CLI Parsing ###
 import click
 
-### I/O ###
-import requests
+# requests, lxml and tqdm are comparatively expensive to import and only
+# needed by commands that go online, so they are imported where they're used.
+# semantic_version is needed by almost everything, but not by --help, so it is
+# imported on the first version parse.
+
+# How long the list of releases on renpy.org is trusted without asking again.
+VERSION_CACHE_TTL = 60 * 60
+
+# The download page that lists every release.
+RELEASES_URL = "https://www.renpy.org/dl/"
+
+# Fresh downloads are split into this many ranges fetched in parallel, as long
+# as every range would be at least MIN_SEGMENT_SIZE bytes.
+DOWNLOAD_SEGMENTS = 4
+MIN_SEGMENT_SIZE = 4 * 1024 * 1024
+
+# How often a download that lost its connection halfway is resumed.
+DOWNLOAD_RETRIES = 3
+
+# Seconds to wait for a connection and then for each read. Without a read
+# timeout a stalled transfer blocks forever instead of being resumed, and it
+# also bounds how long an interrupted install waits for a stalled worker.
+DOWNLOAD_TIMEOUT = (10, 30)
 
-### Parsing ###
-from lxml import html
-from semantic_version import Version
+# Releases already looked up by this process, by registry location, together
+# with whether renpy.org confirmed them or they came from the cache.
+RELEASES = {}
 
-### Display ###
-from tqdm import tqdm
+# Set when the user interrupts an install, so that the download and extraction
+# workers give up at the next block (or read timeout, if the transfer stalled)
+# instead of running to completion.
+STOP = threading.Event()
 
+# These never change while the process is running.
+SYSTEM = platform.system()
+MACHINE = platform.machine()
 
+i86 = re.compile(r"i.*86")
+
+# Deliberately loose: semantic_version.Version performs the strict validation,
+# this only has to pick out candidates in linear time. The optional trailing
+# slash accounts for the directory links on the download page.
+# Digits are spelled [0-9], as \d would also accept non-ASCII digits.
 semver = re.compile(
-    r"^((0|[1-9]\d*)\.(0|[1-9]\d*)\.(0|[1-9]\d*)(-(0|[1-9]\d*|\d*[a-zA-Z-][0-9a-zA-Z-]*)(\.(0|[1-9]\d*|\d*[a-zA-Z-][0-9a-zA-Z-]*))*)?(\+[0-9a-zA-Z-]+(\.[0-9a-zA-Z-]+)*)?)/?$"
+    r"([0-9]+\.[0-9]+\.[0-9]+(?:-[0-9A-Za-z.-]+)?(?:\+[0-9A-Za-z.-]+)?)/?"
 )
+simple_semver = re.compile(r"([0-9]+\.[0-9]+\.[0-9]+)/?")
+
+
+def match_version(name):
+    # Nearly every Ren'Py release is a plain X.Y.Z, and most non-matching names
+    # don't even start with a digit, so try the cheap checks first.
+    if not (name[:1].isascii() and name[:1].isdigit()):
+        return None
+    return simple_semver.fullmatch(name) or semver.fullmatch(name)
 
 
 class AliasedGroup(click.Group):
@@ -57,46 +107,56 @@ class AliasedGroup(click.Group):
         ctx.fail("Too many matches: {}".format(", ".join(sorted(matches))))
 
 
+@functools.total_ordering
 class ComparableVersion:
     def __init__(self, version=None):
         if isinstance(version, str):
-            version = Version(version)
+            version = parse_version(version)
         self.version = version
 
     def __repr__(self):
         return "ComparableVersion(version={})".format(self.version)
 
+    def __hash__(self):
+        return hash(self.version)
+
     def __eq__(self, other):
+        if not isinstance(other, ComparableVersion):
+            return NotImplemented
         return self.version == other.version
 
-    def __ne__(self, other):
-        return self.version != other.version
-
     def __lt__(self, other):
+        if not isinstance(other, ComparableVersion):
+            return NotImplemented
         return self.version < other.version
 
-    def __le__(self, other):
-        return self.version <= other.version
-
-    def __gt__(self, other):
-        return self.version > other.version
-
-    def __ge__(self, other):
-        return self.version >= other.version
-
 
 class RenpyInstance(ComparableVersion):
     def __init__(self, version=None, path=None):
         super(RenpyInstance, self).__init__(version)
         self.path = path
-        self.rapt_path = os.path.join(self.path, "rapt")
-        self.launcher_path = os.path.join(self.path, "launcher")
+
+    # Derived from path on demand, as only a few commands ever need them.
+    @property
+    def rapt_path(self):
+        return os.path.join(self.path, "rapt")
+
+    @property
+    def launcher_path(self):
+        return os.path.join(self.path, "launcher")
 
     def __repr__(self):
         return "RenpyInstance(version={}, path='{}', launcher_path='{}')".format(
             self.version, self.path, self.launcher_path
         )
 
+    def to_dict(self):
+        return {"version": str(self.version), "path": self.path}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["version"], data["path"])
+
 
 class RenpyRelease(ComparableVersion):
     def __init__(self, version=None, url=None):
@@ -107,42 +167,82 @@ class RenpyRelease(ComparableVersion):
         return "RenpyRelease(version={}, url='{}')".format(self.version, self.url)
 
 
+class RangeRequestFailed(Exception):
+    pass
+
+
 class Registry:
+    FORMAT = 1
+
     def __init__(self, filename):
         self.filename = filename
-        self.instances = []
+        self.instances = {}
+        self._mtime = None
 
     def load(self):
-        if not os.path.isfile(self.filename):
+        # Keep the in-memory copy for as long as the file on disk is the one
+        # it was read from or written to, so that repeated lookups are free
+        # but changes made by another renutil process are still picked up.
+        try:
+            mtime = os.stat(self.filename).st_mtime_ns
+        except FileNotFoundError:
             self.persist()
-        with open(self.filename, "rb") as f:
-            self.instances = pickle.load(f)
+            return
+        if mtime == self._mtime:
+            return
+        with open(self.filename, "r") as f:
+            data = json.load(f)
+        # Anything with an unexpected shape is reported as a ValueError, so
+        # that callers can treat it like any other corrupt file.
+        registry_format = data.get("format") if isinstance(data, dict) else None
+        if registry_format != self.FORMAT:
+            raise ValueError("Unsupported registry format: {}".format(registry_format))
+        entries = data.get("instances")
+        if not isinstance(entries, builtins.list):
+            raise ValueError("Malformed registry instances: {!r}".format(entries))
+        instances = {}
+        for entry in entries:
+            if not isinstance(entry, dict) or not all(
+                isinstance(entry.get(key), str) for key in ("version", "path")
+            ):
+                raise ValueError("Malformed registry entry: {!r}".format(entry))
+            instance = RenpyInstance.from_dict(entry)
+            instances[instance.version] = instance
+        self.instances = instances
+        self._mtime = mtime
 
     def persist(self):
-        with open(self.filename, "wb") as f:
-            pickle.dump(self.instances, f)
+        data = {
+            "format": self.FORMAT,
+            "instances": [instance.to_dict() for instance in self.instances.values()],
+        }
+        with open(self.filename, "w") as f:
+            json.dump(data, f)
+        self._mtime = os.stat(self.filename).st_mtime_ns
 
     def clear(self):
-        self.instances = []
+        self.instances = {}
+        self.persist()
+
+    def rebuild(self, instances):
+        self.instances = {instance.version: instance for instance in instances}
         self.persist()
 
     def add_instance(self, instance):
         self.load()
-        if instance in self.instances:
+        if instance.version in self.instances:
             return
 
-        self.instances.append(instance)
+        self.instances[instance.version] = instance
 
         self.persist()
 
     def remove_instance(self, instance):
         self.load()
-        if instance not in self.instances:
+        if instance.version not in self.instances:
             return
 
-        for i, inst in enumerate(self.instances):
-            if inst.version == instance.version:
-                del self.instances[i]
+        del self.instances[instance.version]
 
         self.persist()
 
@@ -150,32 +250,24 @@ class Registry:
         self.load()
         if isinstance(version, str):
             try:
-                version = Version(version)
+                version = parse_version(version)
             except ValueError:
                 return None
 
-        for instance in self.instances:
-            if instance.version == version:
-                return instance
-
-        return None
+        return self.instances.get(version)
 
     def installed(self, version):
         self.load()
         if isinstance(version, str):
             try:
-                version = Version(version)
+                version = parse_version(version)
             except ValueError:
                 return False
 
-        for instance in self.instances:
-            if instance.version == version:
-                return True
-
-        return False
+        return version in self.instances
 
     def __iter__(self):
-        return iter(self.instances)
+        return iter(self.instances.values())
 
 
 @contextmanager
@@ -188,28 +280,88 @@ def cd(dir):
         os.chdir(prevdir)
 
 
+# Sized to hold every release listed on the download page.
+@functools.lru_cache(maxsize=4096)
+def parse_version(version):
+    from semantic_version import Version
+
+    # Plain X.Y.Z releases are the norm, and building those from their parts
+    # skips semantic_version's own regex. Leading zeros are invalid semver, so
+    # leave them to the full parser to reject.
+    parts = version.split(".")
+    if len(parts) == 3 and all(
+        part.isascii() and part.isdigit() and (part == "0" or part[0] != "0")
+        for part in parts
+    ):
+        major, minor, patch = parts
+        return Version(major=int(major), minor=int(minor), patch=int(patch))
+    return Version(version)
+
+
+def require_version(version):
+    try:
+        return parse_version(version)
+    except ValueError:
+        logger.error("Invalid version specifier!")
+        sys.exit(1)
+
+
+@functools.lru_cache(maxsize=None)
+def get_session():
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+
+    session = requests.Session()
+    # Ask for compressed responses explicitly, the download index is a long
+    # list of links and shrinks considerably.
+    session.headers.update({"Accept-Encoding": "gzip, deflate"})
+    session.mount(
+        "https://",
+        HTTPAdapter(
+            pool_connections=4,
+            pool_maxsize=2 * DOWNLOAD_SEGMENTS,
+            max_retries=Retry(total=3, backoff_factor=0.3),
+        ),
+    )
+    return session
+
+
+def probe(url):
+    import requests
+
+    try:
+        r = get_session().head(url, timeout=2, allow_redirects=False)
+    except requests.RequestException:
+        return False
+    return r.status_code < 400
+
+
 def is_online():
-    r = requests.head("https://www.renpy.org")
-    renpy_down = r.status_code == 200
-    r = requests.head("https://www.google.com")
-    google_down = r.status_code == 200
-    if google_down and renpy_down:
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        renpy_up, google_up = executor.map(
+            probe, ("https://www.renpy.org", "https://www.google.com")
+        )
+    if not google_up and not renpy_up:
         return -2
-    elif renpy_down:
+    elif not renpy_up:
         return -1
     return 1
 
 
 def scan_instances(path):
     instances = []
-    for folder in os.listdir(path):
-        m = semver.match(folder)
-        if m:
-            try:
-                version = Version(m.group(1))
-                instances.append(RenpyInstance(version, folder))
-            except ValueError:
+    with os.scandir(path) as it:
+        for entry in it:
+            if not entry.is_dir(follow_symlinks=False):
                 continue
+            m = match_version(entry.name)
+            if m:
+                try:
+                    version = parse_version(m.group(1))
+                    instances.append(RenpyInstance(version, entry.name))
+                except ValueError:
+                    continue
     return instances
 
 
@@ -224,33 +376,98 @@ def assure_state():
             )
         )
         sys.exit(1)
-    instances = scan_instances(CACHE)
-    REGISTRY.clear()
-    for instance in instances:
-        REGISTRY.add_instance(instance)
+    # Instances only come and go as folders directly inside CACHE, which bumps
+    # its mtime, so an index written since then is still accurate.
+    if os.path.isfile(REGISTRY.filename):
+        if os.stat(CACHE).st_mtime_ns < os.stat(REGISTRY.filename).st_mtime_ns:
+            try:
+                REGISTRY.load()
+                return
+            except ValueError:
+                logger.debug("Registry index is corrupt, rebuilding it")
+    sweep_trash(CACHE)
+    REGISTRY.rebuild(scan_instances(CACHE))
 
 
 def valid_version(version):
     if isinstance(version, str):
         try:
-            version = Version(version)
+            version = parse_version(version)
         except ValueError:
             return False
-    for instance in REGISTRY:
-        if instance.version == version:
-            return True
+    if REGISTRY.installed(version):
+        return True
     releases = get_available_versions()
+    for release in releases:
+        if release.version == version:
+            return True
+    # A list served from the cache may predate a new release, so ask renpy.org
+    # once more, unless it just came from there anyway.
+    if RELEASES[CACHE][1]:
+        return False
+    releases = get_available_versions(refresh=True)
     for release in releases:
         if release.version == version:
             return True
     return False
 
 
-def get_available_versions(args=None, unknown=None):
+def get_available_versions(args=None, unknown=None, refresh=False, limit=None):
+    if refresh or CACHE not in RELEASES:
+        RELEASES[CACHE] = load_releases(refresh)
+    releases, _ = RELEASES[CACHE]
+    # Callers mostly only show the newest few, which doesn't need a full sort.
+    if limit is not None:
+        return heapq.nlargest(limit, releases, key=attrgetter("version"))
+    return sorted(releases, key=attrgetter("version"), reverse=True)
+
+
+def load_releases(refresh=False):
     assure_state()
+    cache_file = os.path.join(CACHE, "versions.json")
+    cached = None
+    # Even a refresh reads the cache, so that it can ask for changes only.
+    if os.path.isfile(cache_file):
+        try:
+            with open(cache_file, "r") as f:
+                cached = json.load(f)
+            versions = cached.get("versions") if isinstance(cached, dict) else None
+            if not isinstance(versions, builtins.list) or not all(
+                isinstance(version, str) for version in versions
+            ):
+                raise ValueError("Unexpected version cache layout")
+        except ValueError:
+            cached = None
+            logger.debug("Discarding corrupt version cache: '{}'".format(cache_file))
+
+    fresh = cached and time.time() - os.path.getmtime(cache_file) < VERSION_CACHE_TTL
+    if fresh and not refresh:
+        versions, current = cached["versions"], False
+    else:
+        versions, current = fetch_versions(cache_file, cached)
+
     releases = []
+    for version in versions:
+        url = "https://www.renpy.org/dl/{0}/renpy-{0}-sdk.zip".format(version)
+        releases.append(RenpyRelease(version, url))
+    return releases, current
+
+
+def fetch_versions(cache_file, cached=None):
+    # Returns the versions and whether renpy.org confirmed them just now.
+    from lxml import etree
+
+    headers = {}
+    if cached:
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+
     try:
-        r = requests.get("https://www.renpy.org/dl/")
+        r = get_session().get(
+            RELEASES_URL, headers=headers, stream=True, timeout=DOWNLOAD_TIMEOUT
+        )
     except Exception:
         logger.exception(
             "Could not retrieve version list: No connection could be established."
@@ -259,24 +476,62 @@ def get_available_versions(args=None, unknown=None):
             "This might mean that you are not connected to the internet or that renpy.org is down."
         )
         sys.exit(1)
-    tree = html.fromstring(r.content)
-    links = tree.xpath("//a/text()")
-    for link in links:
-        m = semver.match(link)
+
+    if r.status_code == 304 and cached:
+        logger.debug("Version list not modified, using cache")
+        os.utime(cache_file)
+        return cached["versions"], True
+
+    if r.status_code == 200:
+        r.raw.decode_content = True
+        try:
+            versions = parse_versions(r.raw)
+        except etree.XMLSyntaxError as e:
+            error = "unreadable page ({})".format(e)
+        else:
+            with open(cache_file, "w") as f:
+                json.dump(
+                    {
+                        "etag": r.headers.get("ETag"),
+                        "last_modified": r.headers.get("Last-Modified"),
+                        "versions": versions,
+                    },
+                    f,
+                )
+            return versions, True
+    else:
+        error = "HTTP {}".format(r.status_code)
+        r.close()
+
+    # Never cache an error page, it would hide every release until the TTL ends.
+    if cached:
+        logger.warning(
+            "Could not update the version list: {}, using the cached one".format(error)
+        )
+        return cached["versions"], False
+    logger.error("Could not retrieve version list: {}".format(error))
+    sys.exit(1)
+
+
+def parse_versions(stream):
+    from lxml import etree
+
+    versions = []
+    for _, element in etree.iterparse(stream, tag="a", html=True):
+        m = match_version(element.text or "")
+        element.clear()
         if not m:
             continue
         try:
-            version = Version(m.group(1))
-            url = "https://www.renpy.org/dl/{0}/renpy-{0}-sdk.zip".format(m.group(1))
-            release = RenpyRelease(version, url)
-            releases.append(release)
+            parse_version(m.group(1))
         except ValueError:
             continue
-    return sorted(releases, reverse=True)
+        versions.append(m.group(1))
+    return versions
 
 
 def get_installed_versions(args=None, unknown=None):
-    return sorted(REGISTRY, reverse=True)
+    return sorted(REGISTRY, key=attrgetter("version"), reverse=True)
 
 
 @click.group(cls=AliasedGroup)
@@ -306,9 +561,11 @@ def cli(debug, registry):
         CACHE = registry
     else:
         CACHE = os.path.join(os.path.expanduser("~"), ".renutil")
-    REGISTRY = Registry(os.path.join(CACHE, "index.bin"))
+    REGISTRY = Registry(os.path.join(CACHE, "index.json"))
 
     logger.debug("Registry Location: '{}'".format(CACHE))
+    logger.debug("System: '{}'".format(SYSTEM))
+    logger.debug("Machine: '{}'".format(MACHINE))
 
 
 @cli.command()
@@ -327,11 +584,19 @@ def cli(debug, registry):
     type=int,
     help="Amount of versions to show, sorted in descending order",
 )
-def list(show_all, count):
+@click.option(
+    "--refresh",
+    is_flag=True,
+    help="Fetch the list of available versions even if a cached copy is recent",
+)
+def list(show_all, count, refresh):
     """List all available versions of Ren'Py."""
     assure_state()
     if show_all:
-        releases = get_available_versions()
+        # Only a positive count can be served by a partial sort, anything else
+        # keeps the slice semantics of showing all but the last few.
+        limit = count if count > 0 else None
+        releases = get_available_versions(refresh=refresh, limit=limit)
         if not releases:
             logger.warning("No releases are available online.")
         else:
@@ -351,6 +616,7 @@ def list(show_all, count):
 def show(version):
     """Show detailed information about an installed version of Ren'Py."""
     assure_state()
+    version = require_version(version)
     if not valid_version(version):
         logger.error("Invalid version specifier!")
         sys.exit(1)
@@ -368,47 +634,248 @@ def show(version):
     print("RAPT Url: {}".format(RAPT_URL))
 
 
-def download(url, dest):
-    response = requests.head(url)
-    if response.status_code == 404:
-        logger.error("The package could not be found.")
-        sys.exit(1)
-    file_size = int(response.headers.get("Content-Length", -1))
-    if os.path.exists(dest):
-        first_byte = os.path.getsize(dest)
-    else:
-        first_byte = 0
-    if first_byte >= file_size:
-        return
-    header = {"Range": "bytes={}-{}".format(first_byte, file_size)}
+def get_file_size(path):
+    # A single stat that doesn't race against the file disappearing in between.
+    try:
+        return os.stat(path).st_size
+    except FileNotFoundError:
+        return 0
+
+
+def copy_response(req, f, update, abort=None):
+    from urllib3.exceptions import ProtocolError
+
+    # Copy in 1 MiB blocks and check for an interrupt after each one. What has
+    # been written so far stays on disk, so the download can be resumed.
+    req.raw.decode_content = True
+    while True:
+        if STOP.is_set() or (abort is not None and abort.is_set()):
+            req.close()
+            raise KeyboardInterrupt
+        chunk = req.raw.read(1024 * 1024)
+        if not chunk:
+            break
+        f.write(chunk)
+        update(len(chunk))
+    # Depending on the urllib3 version a connection closed early just looks
+    # like the end of the body, so compare against what the server announced.
+    length = req.headers.get("Content-Length", "")
+    if length.isdigit() and req.raw.tell() < int(length):
+        raise ProtocolError(
+            "Connection closed after {} of {} bytes".format(req.raw.tell(), length)
+        )
+
+
+def download(url, dest, position=0, segments=DOWNLOAD_SEGMENTS):
+    # A partial download from a single stream is simply resumed, anything else
+    # is split into several ranges if the server supports it.
+    if segments > 1 and not os.path.exists(dest):
+        response = get_session().head(
+            url, allow_redirects=True, timeout=DOWNLOAD_TIMEOUT
+        )
+        file_size = response.headers.get("Content-Length", "")
+        ranges = response.headers.get("Accept-Ranges") == "bytes"
+        if response.status_code == 200 and ranges and file_size.isdigit():
+            file_size = int(file_size)
+            if file_size >= segments * MIN_SEGMENT_SIZE:
+                download_segmented(url, dest, file_size, position, segments)
+                return
+    download_stream(url, dest, position)
+
+
+def download_segmented(url, dest, file_size, position, segments):
+    from tqdm import tqdm
+    from urllib3.exceptions import ProtocolError, ReadTimeoutError
+
+    # Every range goes into its own part file, so an interrupted download can
+    # pick up each range where it left off.
+    bounds = [file_size * i // segments for i in range(segments + 1)]
+    parts = ["{}.part{}".format(dest, i) for i in range(segments)]
+    sizes = [get_file_size(part) for part in parts]
+
     progress_bar = tqdm(
         total=file_size,
-        initial=first_byte,
+        initial=sum(sizes),
         unit="B",
         unit_scale=True,
         desc=url.split("/")[-1],
+        position=position,
+        # Don't draw progress bars into logs and pipes.
+        disable=None,
+    )
+    lock = threading.Lock()
+
+    def update(n):
+        with lock:
+            progress_bar.update(n)
+
+    # Set once any range fails, so that the others give up as well. This is
+    # local to this download, as STOP would also end a parallel download.
+    abort = threading.Event()
+
+    def fetch(i):
+        try:
+            retries = DOWNLOAD_RETRIES
+            while True:
+                start = bounds[i] + get_file_size(parts[i])
+                end = bounds[i + 1] - 1
+                if start > end:
+                    return
+                header = {"Range": "bytes={}-{}".format(start, end)}
+                req = get_session().get(
+                    url, headers=header, stream=True, timeout=DOWNLOAD_TIMEOUT
+                )
+                if req.status_code != 206:
+                    req.close()
+                    raise RangeRequestFailed(req.status_code)
+                try:
+                    with open(parts[i], "ab") as f:
+                        copy_response(req, f, update, abort)
+                    return
+                except (ProtocolError, ReadTimeoutError) as e:
+                    retries = resume_or_exit(url, e, retries)
+        except BaseException:
+            abort.set()
+            raise
+
+    try:
+        with ThreadPoolExecutor(max_workers=segments) as executor:
+            futures = [executor.submit(fetch, i) for i in range(segments)]
+    finally:
+        progress_bar.close()
+
+    errors = [future.exception() for future in futures if future.exception()]
+    if any(isinstance(error, RangeRequestFailed) for error in errors):
+        # The server advertised ranges but didn't serve one, so fetch the
+        # whole file in one go instead, which also reports real HTTP errors.
+        logger.debug("Range request failed, downloading {} in one go".format(url))
+        for part in parts:
+            if os.path.exists(part):
+                os.remove(part)
+        download_stream(url, dest, position)
+        return
+    if errors:
+        # The others most likely only stopped because of the first real error.
+        raise next(
+            (error for error in errors if not isinstance(error, KeyboardInterrupt)),
+            errors[0],
+        )
+
+    for i, part in enumerate(parts):
+        if os.path.getsize(part) != bounds[i + 1] - bounds[i]:
+            logger.error("The package download is corrupt, please try again.")
+            for part in parts:
+                os.remove(part)
+            sys.exit(1)
+
+    # Join under a temporary name, so dest only ever holds a valid prefix.
+    with open(dest + ".tmp", "wb") as out:
+        for part in parts:
+            with open(part, "rb") as f:
+                shutil.copyfileobj(f, out, 1024 * 1024)
+    os.replace(dest + ".tmp", dest)
+    for part in parts:
+        os.remove(part)
+
+
+def download_stream(url, dest, position=0):
+    from tqdm import tqdm
+    from urllib3.exceptions import ProtocolError, ReadTimeoutError
+
+    # urllib3's Retry only covers connecting and reading the headers, so the
+    # body is resumed from the partial file here if the connection drops.
+    retries = DOWNLOAD_RETRIES
+    while True:
+        first_byte = get_file_size(dest)
+        # A single ranged GET tells us both whether the file exists and how much
+        # of it is left, so there's no need for a separate HEAD request up
+        # front. Fresh downloads ask for the whole file, which CDNs are more
+        # likely to serve from their cache than a range.
+        header = {"Range": "bytes={}-".format(first_byte)} if first_byte else {}
+        req = get_session().get(
+            url, headers=header, stream=True, timeout=DOWNLOAD_TIMEOUT
+        )
+        if req.status_code == 404:
+            logger.error("The package could not be found.")
+            sys.exit(1)
+        if req.status_code == 416:
+            # The requested range starts at or beyond the end: already complete.
+            req.close()
+            return
+        if req.status_code == 206:
+            mode = "ab"
+            total = req.headers.get("Content-Range", "").rsplit("/", 1)[-1]
+            file_size = int(total) if total.isdigit() else None
+        elif req.status_code == 200:
+            # The server ignored the range, so start over.
+            mode = "wb"
+            first_byte = 0
+            length = req.headers.get("Content-Length", "")
+            file_size = int(length) if length.isdigit() else None
+        else:
+            logger.error(
+                "The package could not be downloaded (HTTP {}).".format(req.status_code)
+            )
+            sys.exit(1)
+        progress_bar = tqdm(
+            total=file_size,
+            initial=first_byte,
+            unit="B",
+            unit_scale=True,
+            desc=url.split("/")[-1],
+            position=position,
+            # Don't draw progress bars into logs and pipes.
+            disable=None,
+        )
+        try:
+            with open(dest, mode) as f:
+                copy_response(req, f, progress_bar.update)
+            return
+        except (ProtocolError, ReadTimeoutError) as e:
+            retries = resume_or_exit(url, e, retries)
+        finally:
+            progress_bar.close()
+
+
+def resume_or_exit(url, error, retries):
+    # A read that timed out may just have been waiting when the user hit Ctrl-C.
+    if STOP.is_set():
+        raise KeyboardInterrupt
+    if not retries:
+        logger.error("The package could not be downloaded: {}".format(error))
+        sys.exit(1)
+    logger.warning(
+        "Lost connection while downloading {}, resuming...".format(url.split("/")[-1])
     )
-    req = requests.get(url, headers=header, stream=True)
-    with open(dest, "ab") as f:
-        for chunk in req.iter_content(chunk_size=1024):
-            if chunk:
-                f.write(chunk)
-                progress_bar.update(1024)
-    progress_bar.close()
+    return retries - 1
+
+
+def get_common_prefix(names):
+    # Narrow down the folder shared by all files in a single pass of C-level
+    # startswith() checks. Files in the archive root don't constrain it.
+    prefix = None
+    for name in names:
+        # Since the prefix ends in a slash, anything below it can't narrow it.
+        if prefix and name.startswith(prefix):
+            continue
+        folder, _, filename = name.rpartition("/")
+        if not filename or not folder:
+            continue
+        folder += "/"
+        if prefix is None:
+            prefix = folder
+        while prefix and not folder.startswith(prefix):
+            prefix = prefix[:-1].rpartition("/")[0]
+            prefix = prefix + "/" if prefix else ""
+        if not prefix:
+            break
+    return prefix or ""
 
 
 def get_members_zip(zip):
-    parts = []
-    for name in zip.namelist():
-        if not name.endswith("/"):
-            data = name.split("/")[:-1]
-            if data:
-                parts.append(data)
-    prefix = os.path.commonprefix(parts)
-    if prefix:
-        prefix = "/".join(prefix) + "/"
-    offset = len(prefix)
-    for zipinfo in zip.infolist():
+    infos = zip.infolist()
+    offset = len(get_common_prefix(zipinfo.filename for zipinfo in infos))
+    for zipinfo in infos:
         name = zipinfo.filename
         if len(name) > offset:
             zipinfo.filename = name[offset:]
@@ -416,42 +883,150 @@ def get_members_zip(zip):
 
 
 def get_members_tar(tar):
-    parts = []
-    for name in tar.getnames():
-        if not name.endswith("/"):
-            data = name.split("/")[:-1]
-            if data:
-                parts.append(data)
-    prefix = os.path.commonprefix(parts)
-    if prefix:
-        prefix = "/".join(prefix) + "/"
-    offset = len(prefix)
-    for tarinfo in tar.getmembers():
+    members = tar.getmembers()
+    offset = len(get_common_prefix(tarinfo.name for tarinfo in members))
+    for tarinfo in members:
         name = tarinfo.name
         if len(name) > offset:
             tarinfo.name = name[offset:]
             yield tarinfo
 
 
+def get_member_target(path, name):
+    # Apply the same rules as ZipFile._extract_member(), so that no member can
+    # end up outside of path: normalize separators, drop drive letters, UNC
+    # prefixes, empty, "." and ".." components, and on Windows also replace
+    # characters that are illegal in file names.
+    name = name.replace("/", os.path.sep)
+    if os.path.altsep:
+        name = name.replace(os.path.altsep, os.path.sep)
+    name = os.path.splitdrive(name)[1]
+    name = os.path.sep.join(
+        part
+        for part in name.split(os.path.sep)
+        if part not in ("", os.path.curdir, os.path.pardir)
+    )
+    if os.path.sep == "\\":
+        name = ZipFile._sanitize_windows_name(name, os.path.sep)
+    return os.path.normpath(os.path.join(path, name))
+
+
+def extract_zip(filename, path, workers=None):
+    with ZipFile(filename, "r") as zip:
+        members = builtins.list(get_members_zip(zip))
+
+    # Resolve every target once and create the directory tree up front so that
+    # the workers neither stat nor race each other in os.makedirs().
+    files = []
+    folders = set()
+    for member in members:
+        target = get_member_target(path, member.filename)
+        if member.is_dir():
+            folders.add(target)
+        else:
+            folders.add(os.path.dirname(target))
+            files.append((member, target))
+    for folder in folders:
+        os.makedirs(folder, exist_ok=True)
+
+    # zlib releases the GIL while inflating, so threads scale with cores.
+    # Each worker opens its own handle to avoid contending on a shared one.
+    workers = workers or os.cpu_count() or 1
+
+    def extract(chunk):
+        with ZipFile(filename, "r") as zip:
+            for member, target in chunk:
+                if STOP.is_set():
+                    raise KeyboardInterrupt
+                with zip.open(member) as src, open(target, "wb") as dst:
+                    shutil.copyfileobj(src, dst, 1024 * 1024)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for _ in executor.map(extract, [files[i::workers] for i in range(workers)]):
+            pass
+
+
+def remove_tree(path, workers=None):
+    # Deleting an instance is bound by the latency of tens of thousands of
+    # unlink() calls, so remove the top-level subtrees concurrently.
+    # Like shutil.rmtree(), refuse to follow a symlinked root, as scandir()
+    # would otherwise empty the folder it points to.
+    if os.path.islink(path):
+        raise OSError("Cannot call remove_tree on a symbolic link: '{}'".format(path))
+    folders = []
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.is_dir(follow_symlinks=False):
+                folders.append(entry.path)
+            else:
+                os.unlink(entry.path)
+
+    with ThreadPoolExecutor(max_workers=workers or os.cpu_count() or 1) as executor:
+        for _ in executor.map(shutil.rmtree, folders):
+            pass
+    os.rmdir(path)
+
+
+def discard_tree(path):
+    # Renaming is atomic, so the instance disappears at once and an interrupted
+    # removal can't leave a half-deleted tree behind that still looks installed.
+    # The slow part runs in the background; the returned future re-raises any
+    # error once the caller waits for it.
+    if os.path.islink(path):
+        raise OSError("Cannot call discard_tree on a symbolic link: '{}'".format(path))
+    trash = "{}.trash".format(path)
+    if os.path.isdir(trash):
+        remove_tree(trash)
+    os.rename(path, trash)
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(remove_tree, trash)
+    executor.shutdown(wait=False)
+    return future
+
+
+def sweep_trash(path):
+    # Remove what interrupted calls to discard_tree() left behind.
+    with os.scandir(path) as it:
+        for entry in it:
+            if entry.name.endswith(".trash") and entry.is_dir(follow_symlinks=False):
+                logger.debug("Removing leftover '{}'".format(entry.path))
+                try:
+                    remove_tree(entry.path)
+                except OSError:
+                    # Most likely another renutil process is removing it.
+                    logger.debug("Could not remove '{}'".format(entry.path))
+
+
 def patch_file(file, target_line, patch, reverse=False):
-    with open(file, "r") as f:
-        data = f.readlines()
-
-    found = False
-    with open(file, "w") as f:
-        for line in data:
-            if found:
-                if reverse:
-                    f.write(line)
-                    f.write(patch)
-                else:
-                    f.write(patch)
-                    f.write(line)
-                found = False
+    # Insert patch after the line following each occurrence of target_line
+    # (reverse) or directly after the line containing it, jumping between
+    # occurrences with str.find() instead of walking the file line by line.
+    with open(file, "r+") as f:
+        data = f.read()
+        parts = []
+        start = 0
+        search = 0
+        while True:
+            index = data.find(target_line, search)
+            if index == -1:
+                break
+            eol = data.find("\n", index) + 1
+            if not eol or eol == len(data):
+                break
+            search = eol
+            if reverse:
+                end = data.find("\n", eol) + 1 or len(data)
             else:
-                f.write(line)
-            if target_line in line:
-                found = True
+                end = eol
+            parts.append(data[start:end])
+            parts.append(patch)
+            start = end
+        if not parts:
+            return
+        parts.append(data[start:])
+        f.seek(0)
+        f.write("".join(parts))
+        f.truncate()
 
 
 @cli.command()
@@ -460,17 +1035,24 @@ def patch_file(file, target_line, patch, reverse=False):
 def install(version, force):
     """Install the specified version of Ren'Py (including RAPT)."""
     assure_state()
+    version = require_version(version)
+    install_path = os.path.join(CACHE, str(version))
+    removal = None
     if REGISTRY.installed(version):
         if force:
             logger.info("Uninstalling {} before reinstalling...".format(version))
             instance = REGISTRY.get_instance(version)
+            # The old tree is deleted while the new files are downloaded.
+            try:
+                removal = discard_tree(os.path.join(CACHE, instance.path))
+            except OSError as e:
+                logger.error("Could not remove {}: {}".format(version, e))
+                sys.exit(1)
             REGISTRY.remove_instance(instance)
-            shutil.rmtree(os.path.join(CACHE, instance.path))
-            logger.info("Done uninstalling")
         else:
             logger.warning("{} is already installed!".format(version))
             sys.exit(0)
-    if not valid_version(version):
+    elif not valid_version(version):
         logger.error("Invalid version specifier!")
         sys.exit(1)
 
@@ -481,29 +1063,53 @@ def install(version, force):
     SDK_URL = "https://www.renpy.org/dl/{}/{}".format(version, sdk_filename)
     RAPT_URL = "https://www.renpy.org/dl/{}/{}".format(version, rapt_filename)
 
-    download(SDK_URL, os.path.join(CACHE, sdk_filename))
-    download(RAPT_URL, os.path.join(CACHE, rapt_filename))
-
-    logger.info("Extracting files...")
-    sdk_zip = ZipFile(os.path.join(CACHE, sdk_filename), "r")
-    rapt_zip = ZipFile(os.path.join(CACHE, rapt_filename), "r")
-    sdk_zip.extractall(
-        path=os.path.join(CACHE, version), members=get_members_zip(sdk_zip)
-    )
-    rapt_zip.extractall(
-        path=os.path.join(CACHE, version, "rapt"), members=get_members_zip(rapt_zip)
-    )
+    # Both downloads are network-bound, so fetch them side by side and start
+    # extracting each archive (CPU and disk-bound) as soon as it has arrived,
+    # while the other one is still downloading.
+    archives = {
+        SDK_URL: (os.path.join(CACHE, sdk_filename), install_path),
+        RAPT_URL: (
+            os.path.join(CACHE, rapt_filename),
+            os.path.join(install_path, "rapt"),
+        ),
+    }
+    with ThreadPoolExecutor(max_workers=2 * len(archives)) as executor:
+        downloads = {
+            executor.submit(download, url, filename, position): url
+            for position, (url, (filename, _)) in enumerate(archives.items())
+        }
+        extractions = []
+        try:
+            for future in as_completed(downloads):
+                future.result()
+                filename, path = archives[downloads[future]]
+                logger.info("Extracting {}...".format(os.path.basename(filename)))
+                extractions.append(executor.submit(extract_zip, filename, path))
+            for future in extractions:
+                future.result()
+        except BaseException:
+            # Leaving the pool waits for all workers, so tell them to stop.
+            STOP.set()
+            raise
+
+    if removal:
+        try:
+            removal.result()
+        except OSError as e:
+            logger.error("Could not remove {}: {}".format(version, e))
+            sys.exit(1)
+        logger.info("Done uninstalling")
 
     logger.info("Installing RAPT...")
-    rapt_path = os.path.join(CACHE, version, "rapt")
+    rapt_path = os.path.join(install_path, "rapt")
 
     arch = get_platform(version)
     if arch == "windows-i686":
-        python_path = os.path.join(CACHE, version, "lib", arch, "python.exe")
+        python_path = os.path.join(install_path, "lib", arch, "python.exe")
     else:
-        python_path = os.path.join(CACHE, version, "lib", arch, "python")
+        python_path = os.path.join(install_path, "lib", arch, "python")
         os.chmod(python_path, S_IRUSR | S_IXUSR)
-    site_package_path = os.path.join(CACHE, version, "lib", arch, "lib", "python2.7")
+    site_package_path = os.path.join(install_path, "lib", arch, "lib", "python2.7")
 
     with cd(rapt_path):
         patch = "sys.path.insert(0, '{}')\n\nimport ssl\nssl._create_default_https_context = ssl._create_unverified_context\n".format(
@@ -530,37 +1136,45 @@ def install(version, force):
                 " ".join((python_path, "-O", "android.py", "installsdk"))
             )
         )
-        install = Popen(
-            [python_path, "-O", "android.py", "installsdk"], stdout=PIPE, stderr=STDOUT
-        )
-        for line in install.stdout:
-            line = line.strip()
-            if line:
-                logger.debug(str(line, "latin-1"))
+        cmd = [python_path, "-O", "android.py", "installsdk"]
+        if logger.isEnabledFor(logging.DEBUG):
+            install = Popen(cmd, stdout=PIPE, stderr=STDOUT, encoding="latin-1")
+            for line in install.stdout:
+                line = line.strip()
+                if line:
+                    logger.debug(line)
+            install.wait()
+        else:
+            # Nobody is going to look at the output, so don't pump it through Python.
+            run(cmd, stdout=DEVNULL, stderr=STDOUT)
     del os.environ["RAPT_NO_TERMS"]
 
     logger.info("Registering instance...")
-    instance = RenpyInstance(version, version)
+    instance = RenpyInstance(version, str(version))
     REGISTRY.add_instance(instance)
 
     head, _ = os.path.split(get_libraries(instance)[0])
+    rapt_root = os.path.join(CACHE, instance.rapt_path)
     if arch != "windows-i686":
-        paths = [
-            os.path.join(head, "python"),
-            os.path.join(head, "pythonw"),
-            os.path.join(head, "renpy"),
-            os.path.join(head, "zsync"),
-            os.path.join(head, "zsyncmake"),
-            os.path.join(CACHE, instance.rapt_path, "prototype", "gradlew"),
-            os.path.join(CACHE, instance.rapt_path, "project", "gradlew"),
-        ]
+        paths = (
+            *(
+                os.path.join(head, name)
+                for name in ("python", "pythonw", "renpy", "zsync", "zsyncmake")
+            ),
+            *(
+                os.path.join(rapt_root, project, "gradlew")
+                for project in ("prototype", "project")
+            ),
+        )
         for path in paths:
-            os.chmod(path, S_IRUSR | S_IXUSR)
+            try:
+                os.chmod(path, S_IRUSR | S_IXUSR)
+            except FileNotFoundError:
+                # Not every release ships every helper binary (e.g. zsync).
+                logger.debug("Skipping missing executable '{}'".format(path))
 
-    for path in (
-        os.path.join(CACHE, instance.rapt_path, "prototype", "gradle.properties"),
-        os.path.join(CACHE, instance.rapt_path, "project", "gradle.properties"),
-    ):
+    for project in ("prototype", "project"):
+        path = os.path.join(rapt_root, project, "gradle.properties")
         with open(path, "r") as f:
             original_content = f.readlines()
 
@@ -579,43 +1193,55 @@ def install(version, force):
 def uninstall(version):
     """Uninstall the specified Ren'Py version."""
     assure_state()
+    version = require_version(version)
     if not REGISTRY.installed(version):
         logger.error("{} is not installed!".format(version))
         sys.exit(1)
     instance = REGISTRY.get_instance(version)
-    REGISTRY.remove_instance(instance)
-    shutil.rmtree(os.path.join(CACHE, instance.path))
+    try:
+        removal = discard_tree(os.path.join(CACHE, instance.path))
+        REGISTRY.remove_instance(instance)
+        removal.result()
+    except OSError as e:
+        logger.error("Could not remove {}: {}".format(version, e))
+        sys.exit(1)
 
 
 def get_platform(version):
-    if isinstance(version, str):
-        version = ComparableVersion(version)
-
-    logger.debug("System: '{}'".format(platform.system()))
-    logger.debug("Machine: '{}'".format(platform.machine()))
-
-    if "Darwin" in platform.system():
-        if version >= ComparableVersion("7.4.0"):
+    if "Darwin" in SYSTEM:
+        if isinstance(version, str):
+            version = parse_version(version)
+        elif isinstance(version, ComparableVersion):
+            version = version.version
+        if version >= parse_version("7.4.0"):
             return "mac-x86_64"
         else:
             return "darwin-x86_64"
-    elif "Windows" in platform.system():
+    elif "Windows" in SYSTEM:
         return "windows-i686"
-    elif "x86_64" in platform.machine() or "amd64" in platform.machine():
+    elif "x86_64" in MACHINE or "amd64" in MACHINE:
         return "linux-x86_64"
-    elif re.match(r"i.*86", platform.machine()):
+    elif i86.match(MACHINE):
         return "linux-i686"
-    elif "Linux" in platform.system():
-        return "linux-{}".format(platform.machine())
+    elif "Linux" in SYSTEM:
+        return "linux-{}".format(MACHINE)
 
 
 def get_libraries(instance):
-    root = instance.path
-    root1 = root
-    root2 = root
-    lib = None
-    arch = get_platform(instance)
-    version = str(instance.version).split(".")
+    # Callers extend the returned command line, so hand out a copy.
+    cmd = find_libraries(CACHE, instance.path, instance.version)[:]
+    # The probing above is cached, but the environment is process state that
+    # may have been changed in the meantime, so always check it here.
+    ld_library_path = os.environ.get("LD_LIBRARY_PATH")
+    if ld_library_path and cmd[0] not in ld_library_path.split(":"):
+        os.environ["LD_LIBRARY_PATH"] = "{}:{}".format(cmd[0], ld_library_path)
+    return cmd
+
+
+@functools.lru_cache(maxsize=None)
+def find_libraries(cache, root, version):
+    arch = get_platform(version)
+    version = str(version).split(".")
     major = int(version[0])
     minor = int(version[1])
     prefix = ""
@@ -626,49 +1252,45 @@ def get_libraries(instance):
         prefix = "py2-"
 
     if arch == "darwin-x86_64" or arch == "mac-x86_64":
-        root1 = root + "/../Resources/autorun"
-        root2 = root + "/../../.."
-    elif arch == "windows-i686":
-        root1 = root
-        root2 = root
-    elif arch == "linux-x86_64":
-        root1 = root
-        root2 = root
-    elif arch == "linux-i686":
-        root1 = root
-        root2 = root
-    elif arch.startswith("linux-"):
-        root1 = root
-        root2 = root
+        roots = (root, root + "/../Resources/autorun", root + "/../../..")
+    elif arch == "windows-i686" or (arch and arch.startswith("linux-")):
+        roots = (root,)
     else:
         logger.error("Could not detect system architecture. It might not be supported.")
         sys.exit(1)
 
-    for folder in [root, root1, root2]:
-        lib = os.path.join(CACHE, folder, "lib", prefix + arch)
-        if os.path.isdir(lib):
+    # Probe every candidate root for both files in a single pass, building
+    # each candidate path only once.
+    lib_folder = os.path.join("lib", prefix + arch)
+    candidates = [os.path.join(cache, folder) for folder in roots]
+    lib = None
+    base_file = None
+    for folder in candidates:
+        if lib is None:
+            path = os.path.join(folder, lib_folder)
+            if os.path.isdir(path):
+                lib = path
+        if base_file is None:
+            path = os.path.join(folder, "renpy.py")
+            if os.path.isfile(path):
+                base_file = path
+        if lib is not None and base_file is not None:
             break
-    if arch == "windows-i686":
-        lib = os.path.join(lib, "python.exe")
-    else:
-        lib = os.path.join(lib, "python")
 
-    if not lib:
+    if lib is None:
         logger.error(
             "Ren'Py platform files not found in '{}'".format(
-                os.path.join(root, "lib", arch)
+                os.path.join(candidates[0], lib_folder)
             )
         )
+        sys.exit(1)
+    if base_file is None:
+        base_file = os.path.join(candidates[-1], "renpy.py")
 
-    if "LD_LIBRARY_PATH" in os.environ and len(os.environ["LD_LIBRARY_PATH"]) != 0:
-        os.environ["LD_LIBRARY_PATH"] = "{}:{}".format(
-            lib, os.environ["LD_LIBRARY_PATH"]
-        )
-
-    for folder in [root, root1, root2]:
-        base_file = os.path.join(CACHE, folder, "renpy.py")
-        if os.path.isfile(base_file):
-            break
+    if arch == "windows-i686":
+        lib = os.path.join(lib, "python.exe")
+    else:
+        lib = os.path.join(lib, "python")
 
     return [lib, "-EO", base_file]
 
@@ -704,6 +1326,7 @@ def launch(version, direct, headless, args):
         renutil launch -d <version> <path_to_project_directory> lint
     """
     assure_state()
+    version = require_version(version)
     if not REGISTRY.installed(version):
         logger.error("{} is not installed!".format(version))
         sys.exit(1)
@@ -730,22 +1353,32 @@ def launch(version, direct, headless, args):
 def cleanup(version):
     """Clean temporary files of the specified Ren'Py version."""
     assure_state()
+    version = require_version(version)
     if not REGISTRY.installed(version):
         logger.error("[salmon]{}[/salmon] is not installed!".format(version))
         sys.exit(1)
     instance = REGISTRY.get_instance(version)
-    paths = [
-        os.path.join(instance.path, "tmp"),
-        os.path.join(instance.rapt_path, "assets"),
-        os.path.join(instance.rapt_path, "bin"),
-        os.path.join(instance.rapt_path, "project", "app", "build"),
-        os.path.join(instance.rapt_path, "project", "app", "src", "main", "assets"),
-    ]
-    for path in paths:
-        full_path = os.path.join(CACHE, path)
-        if os.path.isdir(full_path):
-            logger.info("Cleaning {}".format(full_path))
-            shutil.rmtree(full_path)
+    root = os.path.join(CACHE, instance.path)
+    rapt_root = os.path.join(CACHE, instance.rapt_path)
+    for path in (
+        os.path.join(root, "tmp"),
+        os.path.join(rapt_root, "assets"),
+        os.path.join(rapt_root, "bin"),
+        os.path.join(rapt_root, "project", "app", "build"),
+        os.path.join(rapt_root, "project", "app", "src", "main", "assets"),
+    ):
+        # Most of these usually don't exist, so just try instead of checking.
+        try:
+            mode = os.lstat(path).st_mode
+        except FileNotFoundError:
+            continue
+        if S_ISLNK(mode):
+            logger.warning("Not cleaning {}, it is a symbolic link".format(path))
+            continue
+        if not S_ISDIR(mode):
+            continue
+        remove_tree(path)
+        logger.info("Cleaned {}".format(path))
 
 
 if __name__ == "__main__":
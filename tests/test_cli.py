@@ -1,4 +1,6 @@
 # -*- coding: utf-8 -*-
+import json
+
 import pytest
 
 from renutil import cli
@@ -31,3 +33,104 @@ def test_list_populated(tmp_registry):
     result = runner.invoke(cli, ["-r", tmp_registry, "list"])
     assert result.exit_code == 0
     assert result.stdout == "7.3.5\n"
+
+
+def test_list_picks_up_new_instances(tmp_path):
+    runner = CliRunner()
+    (tmp_path / "7.3.5").mkdir()
+    result = runner.invoke(cli, ["-r", str(tmp_path), "list"])
+    assert result.stdout == "7.3.5\n"
+
+    (tmp_path / "8.0.0").mkdir()
+    result = runner.invoke(cli, ["-r", str(tmp_path), "list"])
+    assert result.stdout == "8.0.0\n7.3.5\n"
+
+
+def test_list_all_uses_fresh_cache(tmp_path):
+    (tmp_path / "versions.json").write_text(
+        json.dumps(
+            {"etag": None, "last_modified": None, "versions": ["7.3.5", "8.0.0"]}
+        )
+    )
+    runner = CliRunner()
+    result = runner.invoke(cli, ["-r", str(tmp_path), "list", "-a"])
+    assert result.exit_code == 0
+    assert result.stdout == "8.0.0\n7.3.5\n"
+
+
+def test_cleanup(tmp_path):
+    (tmp_path / "7.3.5" / "tmp" / "cache").mkdir(parents=True)
+    (tmp_path / "7.3.5" / "rapt" / "bin").mkdir(parents=True)
+    (tmp_path / "7.3.5" / "rapt" / "bin" / "game.apk").write_text("x")
+    runner = CliRunner()
+    result = runner.invoke(cli, ["-r", str(tmp_path), "cleanup", "7.3.5"])
+    assert result.exit_code == 0
+    assert not (tmp_path / "7.3.5" / "tmp").exists()
+    assert not (tmp_path / "7.3.5" / "rapt" / "bin").exists()
+    assert (tmp_path / "7.3.5" / "rapt").is_dir()
+
+
+def test_cleanup_skips_symlinks(tmp_path):
+    precious = tmp_path / "precious"
+    precious.mkdir()
+    (precious / "file").write_text("x")
+    (tmp_path / "7.3.5" / "rapt").mkdir(parents=True)
+    (tmp_path / "7.3.5" / "tmp").symlink_to(precious, target_is_directory=True)
+    (tmp_path / "7.3.5" / "rapt" / "bin").write_text("x")
+    runner = CliRunner()
+    result = runner.invoke(cli, ["-r", str(tmp_path), "cleanup", "7.3.5"])
+    assert result.exit_code == 0
+    assert (tmp_path / "7.3.5" / "tmp").is_symlink()
+    assert (precious / "file").read_text() == "x"
+    assert (tmp_path / "7.3.5" / "rapt" / "bin").is_file()
+
+
+def test_rescan_sweeps_trash(tmp_path):
+    (tmp_path / "7.3.5" / "renpy").mkdir(parents=True)
+    (tmp_path / "8.0.0.trash" / "lib").mkdir(parents=True)
+    (tmp_path / "8.0.0.trash" / "lib" / "file").write_text("x")
+    runner = CliRunner()
+    result = runner.invoke(cli, ["-r", str(tmp_path), "list"])
+    assert result.exit_code == 0
+    assert result.stdout == "7.3.5\n"
+    assert not (tmp_path / "8.0.0.trash").exists()
+
+
+@pytest.mark.parametrize(
+    "content",
+    [
+        "not json",
+        "[]",
+        '{"format": 1}',
+        '{"format": 1, "instances": {}}',
+        '{"format": 1, "instances": ["7.3.5"]}',
+        '{"format": 1, "instances": [{"version": 7, "path": "7.3.5"}]}',
+        '{"format": 1, "instances": [{"version": "x", "path": "7.3.5"}]}',
+    ],
+)
+def test_list_rebuilds_malformed_index(tmp_path, content):
+    (tmp_path / "7.3.5").mkdir()
+    (tmp_path / "index.json").write_text(content)
+    runner = CliRunner()
+    result = runner.invoke(cli, ["-r", str(tmp_path), "list"])
+    assert result.exit_code == 0
+    assert result.stdout == "7.3.5\n"
+
+
+@pytest.mark.parametrize(
+    "count,expected", [("1", "8.0.0\n"), ("0", ""), ("-1", "8.0.0\n7.4.0\n")]
+)
+def test_list_all_count(tmp_path, count, expected):
+    (tmp_path / "versions.json").write_text(
+        json.dumps(
+            {
+                "etag": None,
+                "last_modified": None,
+                "versions": ["7.3.5", "8.0.0", "7.4.0"],
+            }
+        )
+    )
+    runner = CliRunner()
+    result = runner.invoke(cli, ["-r", str(tmp_path), "list", "-a", "-n", count])
+    assert result.exit_code == 0
+    assert result.stdout == expected
@@ -0,0 +1,587 @@
+# -*- coding: utf-8 -*-
+import os
+import json
+import time
+import random
+import threading
+from zipfile import ZipFile, ZIP_DEFLATED
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from renutil import renutil
+from renutil.renutil import (
+    Registry,
+    RenpyInstance,
+    discard_tree,
+    download,
+    extract_zip,
+    get_common_prefix,
+    get_member_target,
+    match_version,
+    patch_file,
+    remove_tree,
+)
+
+PAYLOAD = os.urandom(256 * 1024)
+
+
+class PackageHandler(BaseHTTPRequestHandler):
+    # Serves PAYLOAD with HTTP Range support, except below /norange/, and
+    # fixed responses for the paths in server.pages.
+    def do_HEAD(self):
+        self.respond(head=True)
+
+    def do_GET(self):
+        self.respond()
+
+    def respond(self, head=False):
+        if self.path in self.server.pages:
+            status, body = self.server.pages[self.path]
+            self.send_response(status)
+            self.send_header("Content-Length", str(len(body)))
+            self.end_headers()
+            if not head:
+                self.wfile.write(body)
+            return
+        if self.path.startswith("/missing/"):
+            self.send_response(404)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        ranges = not self.path.startswith("/norange/")
+        # Below /ignorerange/ ranges are advertised, but never served.
+        serve_ranges = ranges and not self.path.startswith("/ignorerange/")
+        header = self.headers.get("Range")
+        self.server.ranges.append(header)
+        body = PAYLOAD
+        if serve_ranges and header:
+            start, _, end = header.replace("bytes=", "").partition("-")
+            start = int(start)
+            end = int(end) if end else len(PAYLOAD) - 1
+            stop = end + 1
+            if start >= len(PAYLOAD):
+                self.send_response(416)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            body = PAYLOAD[start:stop]
+            self.send_response(206)
+            self.send_header(
+                "Content-Range", "bytes {}-{}/{}".format(start, end, len(PAYLOAD))
+            )
+        else:
+            self.send_response(200)
+        if ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        if head:
+            return
+        if self.server.drops:
+            # Announce the whole body, but hang up halfway through.
+            self.server.drops -= 1
+            self.wfile.write(body[: len(body) // 2])
+            self.close_connection = True
+            return
+        if self.server.stalls:
+            # Announce the whole body, but stop sending halfway through.
+            self.server.stalls -= 1
+            self.wfile.write(body[: len(body) // 2])
+            self.wfile.flush()
+            self.server.unstall.wait(10)
+            self.close_connection = True
+            return
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), PackageHandler)
+    httpd.ranges = []
+    httpd.drops = 0
+    httpd.pages = {}
+    httpd.stalls = 0
+    httpd.unstall = threading.Event()
+    thread = threading.Thread(target=httpd.serve_forever, daemon=True)
+    thread.start()
+    yield httpd
+    httpd.unstall.set()
+    httpd.shutdown()
+    httpd.server_close()
+
+
+def package_url(server, path="renpy-1.0.0-sdk.zip"):
+    return "http://127.0.0.1:{}/{}".format(server.server_address[1], path)
+
+
+@pytest.fixture
+def segmented(monkeypatch):
+    monkeypatch.setattr(renutil, "MIN_SEGMENT_SIZE", 1024)
+
+
+def test_extract_zip_strips_prefix(tmp_path):
+    archive = tmp_path / "renpy-1.0.0-sdk.zip"
+    with ZipFile(archive, "w", ZIP_DEFLATED) as zip:
+        zip.writestr("renpy-1.0.0-sdk/", "")
+        zip.writestr("renpy-1.0.0-sdk/empty/", "")
+        zip.writestr("renpy-1.0.0-sdk/renpy.py", "print('renpy')")
+        zip.writestr("renpy-1.0.0-sdk/../escape.txt", "x")
+        for i in range(32):
+            zip.writestr("renpy-1.0.0-sdk/lib/{}/{}.txt".format(i % 4, i), str(i))
+
+    dest = tmp_path / "1.0.0"
+    extract_zip(str(archive), str(dest), workers=4)
+
+    assert (dest / "renpy.py").read_text() == "print('renpy')"
+    assert (dest / "empty").is_dir()
+    assert (dest / "lib" / "3" / "31.txt").read_text() == "31"
+    assert (dest / "escape.txt").exists()
+    assert not (tmp_path / "escape.txt").exists()
+
+
+@pytest.mark.parametrize(
+    "name",
+    [
+        "../escape.txt",
+        "/absolute.txt",
+        "a/./b/../c.txt",
+        "..\\escape.txt",
+        "C:/drive.txt",
+        "C:\\drive.txt",
+        "//server/share/unc.txt",
+        "bad:name?.txt",
+    ],
+)
+def test_get_member_target_matches_zipfile(tmp_path, name):
+    archive = tmp_path / "archive.zip"
+    with ZipFile(archive, "w") as zip:
+        zip.writestr(name, "x")
+    with ZipFile(archive) as zip:
+        expected = zip.extract(zip.infolist()[0], str(tmp_path / "out"))
+
+    assert get_member_target(str(tmp_path / "out"), name) == expected
+
+
+@pytest.mark.parametrize(
+    "name,version",
+    [
+        ("7.3.5", "7.3.5"),
+        ("8.0.0/", "8.0.0"),
+        ("7.4.0-beta.1+build", "7.4.0-beta.1+build"),
+        ("\u0663.\u0663.\u0663", None),
+        ("7.\u0663.5", None),
+        ("7.3.5-\u0663", None),
+        ("renpy-7.3.5", None),
+        ("", None),
+    ],
+)
+def test_match_version(name, version):
+    m = match_version(name)
+    assert (m.group(1) if m else None) == version
+
+
+@pytest.mark.parametrize(
+    "names,prefix",
+    [
+        (["renpy-sdk/a.txt", "renpy-sdk/lib/b"], "renpy-sdk/"),
+        (["renpy-sdk/", "renpy-sdk/a/b/c", "renpy-sdk/a/d"], "renpy-sdk/a/"),
+        (["root.txt", "sdk/a"], "sdk/"),
+        (["sdk/a", "sdkx/b"], ""),
+        (["a/b/c", "a/bc/d"], "a/"),
+        (["only/dirs/"], ""),
+        ([], ""),
+    ],
+)
+def test_get_common_prefix(names, prefix):
+    assert get_common_prefix(names) == prefix
+
+
+def test_get_common_prefix_matches_commonprefix():
+    # Cross-check against the straightforward os.path.commonprefix() version.
+    rng = random.Random(1)
+    for _ in range(500):
+        names = []
+        for _ in range(rng.randint(0, 6)):
+            name = "/".join(rng.choice("ab") for _ in range(rng.randint(1, 4)))
+            # Some members are folders.
+            names.append(name + rng.choice(["", "/"]))
+        parts = [name.split("/")[:-1] for name in names if not name.endswith("/")]
+        expected = os.path.commonprefix([part for part in parts if part])
+        expected = "/".join(expected) + "/" if expected else ""
+        assert get_common_prefix(names) == expected, names
+
+
+@pytest.mark.parametrize(
+    "content,reverse,expected",
+    [
+        ("a\nimport sys\nb\n", False, "a\nimport sys\nP\nb\n"),
+        ("a\nimport sys\nb\n", True, "a\nimport sys\nb\nP\n"),
+        ("import sys, os\nb\nc\n", True, "import sys, os\nb\nP\nc\n"),
+        # Repeated matches.
+        (
+            "import sys\nx\nimport sys\ny\n",
+            False,
+            "import sys\nP\nx\nimport sys\nP\ny\n",
+        ),
+        (
+            "import sys\nx\nimport sys\ny\n",
+            True,
+            "import sys\nx\nP\nimport sys\ny\nP\n",
+        ),
+        # Matches on consecutive lines.
+        (
+            "import sys\nimport sys\nz\n",
+            False,
+            "import sys\nP\nimport sys\nP\nz\n",
+        ),
+        (
+            "import sys\nimport sys\nz\n",
+            True,
+            "import sys\nimport sys\nP\nz\nP\n",
+        ),
+        # A match on the last line has no line to patch after.
+        ("a\nimport sys\n", False, "a\nimport sys\n"),
+        ("a\nimport sys\n", True, "a\nimport sys\n"),
+        ("a\nimport sys", True, "a\nimport sys"),
+        # No trailing newline.
+        ("import sys\nb", False, "import sys\nP\nb"),
+        ("import sys\nb", True, "import sys\nbP\n"),
+        ("no match\n", True, "no match\n"),
+        ("", False, ""),
+    ],
+)
+def test_patch_file(tmp_path, content, reverse, expected):
+    path = tmp_path / "android.py"
+    path.write_text(content)
+    patch_file(str(path), "import sys", "P\n", reverse=reverse)
+    assert path.read_text() == expected
+
+
+def test_registry_roundtrip(tmp_path):
+    filename = str(tmp_path / "index.json")
+    registry = Registry(filename)
+    registry.add_instance(RenpyInstance("7.3.5", "7.3.5"))
+    registry.add_instance(RenpyInstance("8.0.0", "8.0.0"))
+    registry.remove_instance(RenpyInstance("8.0.0", "8.0.0"))
+
+    registry = Registry(filename)
+    assert registry.installed("7.3.5")
+    assert not registry.installed("8.0.0")
+    assert not registry.installed("not-a-version")
+    assert registry.get_instance("7.3.5").path == "7.3.5"
+    assert [instance.path for instance in registry] == ["7.3.5"]
+
+
+def test_remove_tree(tmp_path):
+    root = tmp_path / "7.3.5"
+    for i in range(8):
+        (root / "lib" / str(i)).mkdir(parents=True)
+        (root / "lib" / str(i) / "file").write_text("x")
+    (root / "renpy.py").write_text("x")
+
+    remove_tree(str(root), workers=4)
+
+    assert not root.exists()
+
+
+def test_remove_tree_keeps_symlink_targets(tmp_path):
+    precious = tmp_path / "precious"
+    (precious / "sub").mkdir(parents=True)
+    (precious / "file").write_text("x")
+
+    root = tmp_path / "7.3.5"
+    (root / "lib").mkdir(parents=True)
+    (root / "folder").symlink_to(precious, target_is_directory=True)
+    (root / "file").symlink_to(precious / "file")
+    (root / "tmp").symlink_to(precious, target_is_directory=True)
+
+    with pytest.raises(OSError):
+        remove_tree(str(root / "tmp"))
+    assert (root / "tmp").is_symlink()
+
+    remove_tree(str(root), workers=4)
+
+    assert not root.exists()
+    assert (precious / "file").read_text() == "x"
+    assert (precious / "sub").is_dir()
+
+
+def test_discard_tree(tmp_path):
+    root = tmp_path / "7.3.5"
+    (root / "lib").mkdir(parents=True)
+    (root / "lib" / "file").write_text("x")
+    # Leftover of an interrupted removal.
+    (tmp_path / "7.3.5.trash").mkdir()
+
+    removal = discard_tree(str(root))
+    assert not root.exists()
+    assert not match_version("7.3.5.trash")
+    removal.result()
+
+    assert [*tmp_path.iterdir()] == []
+
+
+def test_discard_tree_reports_errors(tmp_path, monkeypatch):
+    root = tmp_path / "7.3.5"
+    root.mkdir()
+
+    def remove_tree(path, workers=None):
+        raise PermissionError(path)
+
+    monkeypatch.setattr(renutil, "remove_tree", remove_tree)
+    removal = discard_tree(str(root))
+    with pytest.raises(PermissionError):
+        removal.result()
+
+
+def test_discard_tree_refuses_symlinks(tmp_path):
+    precious = tmp_path / "precious"
+    precious.mkdir()
+    (precious / "file").write_text("x")
+    (tmp_path / "7.3.5").symlink_to(precious, target_is_directory=True)
+
+    with pytest.raises(OSError):
+        discard_tree(str(tmp_path / "7.3.5"))
+    assert (tmp_path / "7.3.5").is_symlink()
+    assert (precious / "file").read_text() == "x"
+
+
+def test_download_segmented(tmp_path, server, segmented):
+    dest = tmp_path / "renpy-1.0.0-sdk.zip"
+    download(package_url(server), str(dest), segments=4)
+
+    assert dest.read_bytes() == PAYLOAD
+    assert [*tmp_path.iterdir()] == [dest]
+    assert len([header for header in server.ranges if header]) == 4
+
+
+def test_download_segmented_resumes_parts(tmp_path, server, segmented):
+    dest = tmp_path / "renpy-1.0.0-sdk.zip"
+    quarter = len(PAYLOAD) // 4
+    half = quarter // 2
+    # One range half done, one complete, the others not started.
+    (tmp_path / "renpy-1.0.0-sdk.zip.part0").write_bytes(PAYLOAD[:half])
+    start = 2 * quarter
+    part2 = PAYLOAD[start:][:quarter]
+    (tmp_path / "renpy-1.0.0-sdk.zip.part2").write_bytes(part2)
+    download(package_url(server), str(dest), segments=4)
+
+    assert dest.read_bytes() == PAYLOAD
+    assert [*tmp_path.iterdir()] == [dest]
+    assert {header for header in server.ranges if header} == {
+        "bytes={}-{}".format(half, quarter - 1),
+        "bytes={}-{}".format(quarter, 2 * quarter - 1),
+        "bytes={}-{}".format(3 * quarter, len(PAYLOAD) - 1),
+    }
+
+
+def test_download_segmented_falls_back_without_ranges(tmp_path, server, segmented):
+    dest = tmp_path / "renpy-1.0.0-sdk.zip"
+    download(package_url(server, "ignorerange/renpy-1.0.0-sdk.zip"), str(dest))
+
+    assert dest.read_bytes() == PAYLOAD
+    assert [*tmp_path.iterdir()] == [dest]
+    # The last request is the plain download.
+    assert server.ranges[-1] is None
+
+
+def test_download_segmented_rejects_corrupt_parts(tmp_path, server, segmented):
+    dest = tmp_path / "renpy-1.0.0-sdk.zip"
+    quarter = len(PAYLOAD) // 4
+    # A part that is longer than its range can't be trusted.
+    (tmp_path / "renpy-1.0.0-sdk.zip.part1").write_bytes(b"x" * (quarter + 1))
+    with pytest.raises(SystemExit):
+        download(package_url(server), str(dest), segments=4)
+
+    assert [*tmp_path.iterdir()] == []
+
+
+@pytest.fixture
+def registry(tmp_path, monkeypatch):
+    monkeypatch.setattr(renutil, "CACHE", str(tmp_path), raising=False)
+    registry = Registry(str(tmp_path / "index.json"))
+    monkeypatch.setattr(renutil, "REGISTRY", registry, raising=False)
+    monkeypatch.setattr(renutil, "RELEASES", {})
+    return registry
+
+
+@pytest.fixture
+def cache(registry, monkeypatch):
+    fetched = []
+
+    def fetch_versions(cache_file, cached=None):
+        fetched.append(cached and cached["versions"])
+        return ["7.3.5", "8.0.0"], True
+
+    monkeypatch.setattr(renutil, "fetch_versions", fetch_versions)
+    return fetched
+
+
+def test_valid_version_refreshes_fresh_cache(tmp_path, cache):
+    (tmp_path / "versions.json").write_text(
+        json.dumps({"etag": None, "last_modified": None, "versions": ["7.3.5"]})
+    )
+    assert renutil.valid_version("7.3.5")
+    assert cache == []
+    assert renutil.valid_version("8.0.0")
+    # The refresh still sends the cached ETag along.
+    assert cache == [["7.3.5"]]
+    assert not renutil.valid_version("9.0.0")
+    assert cache == [["7.3.5"]]
+
+
+def test_valid_version_trusts_a_list_just_fetched(cache):
+    assert renutil.valid_version("8.0.0")
+    assert not renutil.valid_version("9.0.0")
+    assert cache == [None]
+
+
+@pytest.mark.parametrize("content", ['{"foo": 1}', "[]", '{"versions": "7.3.5"}'])
+def test_load_releases_discards_malformed_cache(tmp_path, cache, content):
+    (tmp_path / "versions.json").write_text(content)
+    versions = [release.version for release in renutil.get_available_versions()]
+    assert versions == [renutil.parse_version("8.0.0"), renutil.parse_version("7.3.5")]
+    assert cache == [None]
+
+
+def test_download_stops_stalled_transfer_on_interrupt(tmp_path, server, monkeypatch):
+    stop = threading.Event()
+    monkeypatch.setattr(renutil, "STOP", stop)
+    monkeypatch.setattr(renutil, "DOWNLOAD_TIMEOUT", (5, 1))
+    server.stalls = 1
+    dest = tmp_path / "renpy-1.0.0-sdk.zip"
+    timer = threading.Timer(0.3, stop.set)
+    timer.start()
+    start = time.monotonic()
+    with pytest.raises(KeyboardInterrupt):
+        download(package_url(server), str(dest), segments=1)
+
+    # Given up after the read timeout instead of resuming or waiting for more.
+    assert time.monotonic() - start < 3
+    assert server.ranges == [None]
+
+    stop.clear()
+    download(package_url(server), str(dest), segments=1)
+    assert dest.read_bytes() == PAYLOAD
+
+
+@pytest.mark.parametrize("segments", [1, 4])
+def test_download_resumes_dropped_connections(tmp_path, server, segmented, segments):
+    server.drops = 2
+    dest = tmp_path / "renpy-1.0.0-sdk.zip"
+    download(package_url(server), str(dest), segments=segments)
+
+    assert dest.read_bytes() == PAYLOAD
+    assert server.drops == 0
+
+
+@pytest.mark.parametrize("segments", [1, 4])
+def test_download_resumes_stalled_connections(
+    tmp_path, server, segmented, monkeypatch, segments
+):
+    monkeypatch.setattr(renutil, "DOWNLOAD_TIMEOUT", (5, 0.5))
+    server.stalls = 2
+    dest = tmp_path / "renpy-1.0.0-sdk.zip"
+    download(package_url(server), str(dest), segments=segments)
+
+    assert dest.read_bytes() == PAYLOAD
+    assert server.stalls == 0
+
+
+def test_download_gives_up_after_retries(tmp_path, server):
+    server.drops = renutil.DOWNLOAD_RETRIES + 1
+    dest = tmp_path / "renpy-1.0.0-sdk.zip"
+    with pytest.raises(SystemExit):
+        download(package_url(server), str(dest), segments=1)
+
+    assert len(server.ranges) == renutil.DOWNLOAD_RETRIES + 1
+    assert PAYLOAD.startswith(dest.read_bytes())
+
+
+def test_download_stream_fresh(tmp_path, server):
+    dest = tmp_path / "renpy-1.0.0-sdk.zip"
+    download(package_url(server), str(dest), segments=1)
+
+    assert dest.read_bytes() == PAYLOAD
+    # Fresh downloads don't ask for a range, so CDNs can serve them cached.
+    assert server.ranges == [None]
+
+
+def test_download_stream_resumes(tmp_path, server):
+    dest = tmp_path / "renpy-1.0.0-sdk.zip"
+    dest.write_bytes(PAYLOAD[:1000])
+    download(package_url(server), str(dest))
+
+    assert dest.read_bytes() == PAYLOAD
+    assert server.ranges == ["bytes=1000-"]
+
+
+def test_download_stream_restarts_without_range_support(tmp_path, server):
+    dest = tmp_path / "renpy-1.0.0-sdk.zip"
+    dest.write_bytes(b"x" * 1000)
+    download(package_url(server, "norange/renpy-1.0.0-sdk.zip"), str(dest))
+
+    assert dest.read_bytes() == PAYLOAD
+
+
+def test_download_stream_complete(tmp_path, server):
+    dest = tmp_path / "renpy-1.0.0-sdk.zip"
+    dest.write_bytes(PAYLOAD)
+    download(package_url(server), str(dest))
+
+    assert dest.read_bytes() == PAYLOAD
+    assert server.ranges == ["bytes={}-".format(len(PAYLOAD))]
+
+
+def test_download_stream_missing(tmp_path, server):
+    dest = tmp_path / "renpy-1.0.0-sdk.zip"
+    with pytest.raises(SystemExit):
+        download(package_url(server, "missing/renpy-1.0.0-sdk.zip"), str(dest))
+
+
+INDEX = b"""<html><body>
+<a href="7.3.5/">7.3.5/</a> <a href="8.0.0/">8.0.0/</a> <a href="../">Parent</a>
+</body></html>"""
+
+
+@pytest.fixture
+def index(server, registry, monkeypatch):
+    monkeypatch.setattr(renutil, "RELEASES_URL", package_url(server, "dl/"))
+    return server.pages
+
+
+def test_fetch_versions_caches_the_index(tmp_path, index):
+    index["/dl/"] = (200, INDEX)
+    versions = [str(release.version) for release in renutil.get_available_versions()]
+    assert versions == ["8.0.0", "7.3.5"]
+    cached = json.loads((tmp_path / "versions.json").read_text())
+    assert cached["versions"] == ["7.3.5", "8.0.0"]
+
+
+@pytest.mark.parametrize("page", [(503, b"<html>Unavailable</html>"), (200, b"")])
+def test_fetch_versions_rejects_errors(tmp_path, index, page):
+    index["/dl/"] = page
+    with pytest.raises(SystemExit):
+        renutil.get_available_versions()
+    assert not (tmp_path / "versions.json").exists()
+
+
+@pytest.mark.parametrize("page", [(503, b"<html>Unavailable</html>"), (200, b"")])
+def test_fetch_versions_falls_back_to_the_cache(tmp_path, index, page):
+    index["/dl/"] = page
+    cache_file = tmp_path / "versions.json"
+    cache_file.write_text(
+        json.dumps({"etag": None, "last_modified": None, "versions": ["7.3.5"]})
+    )
+    # Expired, so the index is fetched again.
+    os.utime(cache_file, (0, 0))
+    content = cache_file.read_text()
+
+    versions = [str(release.version) for release in renutil.get_available_versions()]
+    assert versions == ["7.3.5"]
+    assert cache_file.read_text() == content
+    assert cache_file.stat().st_mtime == 0